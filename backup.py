@@ -12,14 +12,45 @@ Backup Utility
 """
 
 import argparse
+import bisect
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import attrgetter
 from pathlib import Path
 from datetime import datetime, timezone
+from functools import cached_property
+from itertools import chain
+import hashlib
 import json
+import os
+import shutil
+import stat
+import tempfile
 import time
 import zipfile
+import zlib
 import logging
 
+try:
+    # optional, parses and serializes metadata several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
 DEFAULT_OUTOUT_DIR = Path().home() / ".backup"
+# zlib level 1 (BEST_SPEED) deflates far faster than the default level 6 at a small cost in ratio
+DEFAULT_COMPRESS_LEVEL = 1
+# blake2b digest size in bytes, used to fingerprint file contents across backups
+DIGEST_SIZE = 16
+# files up to this size are deflated whole on worker threads, bigger ones are streamed
+PARALLEL_MAX_FILE_SIZE = 4 * 1024 * 1024
+# read size for streamed files, ZipFile.write only reads 8 KiB at a time
+COPY_BUFSIZE = 1024 * 1024
+# access pattern hints, posix_fadvise is not available on every platform
+FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
 
 
 def setup_logging(verbose=False):
@@ -31,65 +62,189 @@ def setup_logging(verbose=False):
     )
 
 
-# Raw formatter makes sure module docstring format (new lines in particular) is preserved
-parser = argparse.ArgumentParser(
-    "backup",
-    add_help=True,
-    description=__doc__,
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-)
-
-# ---------------------- ADD SUBCOMMANDS ---------------------- #
-
-subcommands = parser.add_subparsers(dest="command")
-
-create_command = subcommands.add_parser("create", help="create backups")
-list_command = subcommands.add_parser("list", help="list backups")
-restore_command = subcommands.add_parser("restore", help="restore backups")
-remove_command = subcommands.add_parser("rm", help="remove backups")
-
-# ----------------------- MAIN COMMAND ------------------------ #
-parser.add_argument(
-    "-v", "--verbose", action="store_true", help="turn verbose output on"
-)
-parser.add_argument(
-    "-o",
-    "--output",
-    default=DEFAULT_OUTOUT_DIR,
-    help=f"set output  directory, default: {DEFAULT_OUTOUT_DIR}",
-)
-
-# --------------------- CREATE SUBCOMMAND --------------------- #
-
-# Positional arguments have their dest equal to their name automatically. Explicitly setting dest will raise error
-create_command.add_argument(
-    "create_dir_paths",
-    nargs="+",
-    help="provide one or  more directories to be backed up",
-)
-
-# --------------------- RESTORE SUBCOMMAND --------------------- #
-restore_command.add_argument(
-    "restore_bak_ids",
-    nargs="+",
-    help="provide one or  more backup id's to be restored",
-)
-
-# --------------------- REMOVE SUBCOMMAND --------------------- #
-remove_command.add_argument(
-    "rm_bak_ids",
-    nargs="+",
-    help="provide one or  more backup id's to be removed",
-)
-remove_command.add_argument(
-    "-a",
-    "--all",
-    dest="rm_all",
-    action="store_true",
-    help="remove all backups of the directory",
-)
-# Positional arguments have their dest equal to their name automatically. Explicitly setting dest will raise error
-#
+def build_parser() -> argparse.ArgumentParser:
+    """
+    builds the command line parser, only when running as a script
+    so that importing the module stays cheap
+    """
+    # Raw formatter makes sure module docstring format (new lines in particular) is preserved
+    parser = argparse.ArgumentParser(
+        "backup",
+        add_help=True,
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    # ---------------------- ADD SUBCOMMANDS ---------------------- #
+
+    subcommands = parser.add_subparsers(dest="command")
+
+    create_command = subcommands.add_parser("create", help="create backups")
+    list_command = subcommands.add_parser("list", help="list backups")
+    restore_command = subcommands.add_parser("restore", help="restore backups")
+    remove_command = subcommands.add_parser("rm", help="remove backups")
+
+    # ----------------------- MAIN COMMAND ------------------------ #
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="turn verbose output on"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=DEFAULT_OUTOUT_DIR,
+        help=f"set output  directory, default: {DEFAULT_OUTOUT_DIR}",
+    )
+
+    # --------------------- CREATE SUBCOMMAND --------------------- #
+
+    # Positional arguments have their dest equal to their name automatically. Explicitly setting dest will raise error
+    create_command.add_argument(
+        "create_dir_paths",
+        nargs="+",
+        help="provide one or  more directories to be backed up",
+    )
+    create_command.add_argument(
+        "-l",
+        "--compress-level",
+        type=int,
+        choices=[0, 1, 6, 9],
+        default=DEFAULT_COMPRESS_LEVEL,
+        help=f"zlib compression level, 0 stores files uncompressed, default: {DEFAULT_COMPRESS_LEVEL}",
+    )
+
+    # --------------------- RESTORE SUBCOMMAND --------------------- #
+    restore_command.add_argument(
+        "restore_bak_ids",
+        nargs="+",
+        help="provide one or  more backup id's to be restored",
+    )
+
+    # --------------------- REMOVE SUBCOMMAND --------------------- #
+    remove_command.add_argument(
+        "rm_bak_ids",
+        nargs="+",
+        help="provide one or  more backup id's to be removed",
+    )
+    remove_command.add_argument(
+        "-a",
+        "--all",
+        dest="rm_all",
+        action="store_true",
+        help="remove all backups of the directory",
+    )
+    return parser
+
+
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _json_dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
+def _entry_id(bak_dir: Path, timestamp: float) -> str:
+    """deterministic 8 hex digit backup id, unlike hash() it is the same across runs"""
+    key = f"{bak_dir}|{timestamp}".encode()
+    return hashlib.blake2b(key, digest_size=4).hexdigest()
+
+
+def _truncate(text: str, width: int) -> str:
+    """keeps the end of text that is too long for its column, marking the cut with ..."""
+    return text if len(text) <= width else "..." + text[-width + 3 :]
+
+
+def _file_digest(filepath: str | Path) -> str:
+    """returns the blake2b hex digest of a file's contents"""
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(filepath, "rb", buffering=0) as f:
+        while chunk := f.read(COPY_BUFSIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _fadvise(fd: int, advice: int | None):
+    """hints the kernel about how a file is going to be read, where supported"""
+    if advice is not None:
+        os.posix_fadvise(fd, 0, 0, advice)
+
+
+@contextmanager
+def _open_source(path: str):
+    """
+    opens a file that gets archived, which is read once from start to end.
+    Its pages are dropped from the page cache afterwards, so that a large backup does not
+    evict the working set of everything else running on the host
+    """
+    with open(path, "rb", buffering=0) as f:
+        _fadvise(f.fileno(), FADV_SEQUENTIAL)
+        try:
+            yield f
+        finally:
+            _fadvise(f.fileno(), FADV_DONTNEED)
+
+
+def _deflate_file(
+    path: str, rel_path: str, compress_level: int
+) -> tuple[zipfile.ZipInfo, bytes, str]:
+    """
+    compresses a whole file into a raw deflate stream and digests it, meant to run on a
+    worker thread. zlib and hashlib release the GIL, so workers compress in parallel
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, rel_path)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    with _open_source(path) as f:
+        data = f.read()
+    # negative wbits produce a raw deflate stream, without the zlib header and trailer
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(data) + compressor.flush()
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(payload)
+    zinfo.CRC = zlib.crc32(data)
+    return zinfo, payload, hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def _fallocate(fd: int, size: int):
+    """reserves disk space for a file up front so it gets laid out contiguously, where supported"""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # not every filesystem supports it, the copy itself will allocate
+            pass
+
+
+def _write_raw_member(zipf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, payload: bytes):
+    """
+    appends an already compressed member to an archive, zinfo must carry its CRC and sizes
+    zipfile has no public API for this, so it mirrors what ZipFile.open(..., "w") does
+    """
+    zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+    zipf.fp.seek(zipf.start_dir)
+    zinfo.header_offset = zipf.fp.tell()
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zipf.fp.write(zinfo.FileHeader(zip64))
+    zipf.fp.write(payload)
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _stream_file(zipf: zipfile.ZipFile, path: str, rel_path: str) -> str:
+    """
+    writes a file into an archive, reading and compressing it in large blocks,
+    returns the digest of the archived contents
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, rel_path)
+    zinfo.compress_type = zipf.compression
+    zinfo._compresslevel = zipf.compresslevel
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with _open_source(path) as src, zipf.open(zinfo, "w") as dst:
+        while chunk := src.read(COPY_BUFSIZE):
+            dst.write(chunk)
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 
 class MetaEntry:
@@ -98,21 +253,35 @@ class MetaEntry:
         self._path = Path(data["path"])
         self._timestamp: int = data["timestamp"]
         self._file_count: int = data["file_count"]
-        # We need to explicitly repr as the print and logging modules use str by default
-        logging.debug(f"created {repr(self)}")
+        # manifest of the files stored in this backup, relative path -> [size, mtime, digest]
+        # entries created before manifests were introduced have none
+        self._files: dict[str, list] = data.get("files", {})
+        # files of the manifest found unchanged by later backups, with their current mtime.
+        # They go away with the entry, as its zip is what holds their contents
+        self._verified: dict[str, list] = data.get("verified", {})
+        if "id" in data:
+            self._id: str = data["id"]
+        else:
+            # entries stored before ids were persisted keep their original id
+            self._id = hex(abs(hash(self._timestamp)))[2:10]
+        # the f-string would be formatted even with debug logging off
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # We need to explicitly repr as the print and logging modules use str by default
+            logging.debug(f"created {repr(self)}")
 
     @property
     def id_(self):
-        return hex(hash(self))[2:10]
+        return self._id
 
-    @property
+    @cached_property
     def datetime(self):
-        return datetime.strftime(
-            datetime.fromtimestamp(self._timestamp), "'%Y-%m-%d %H:%M:%S'"
-        )[1:-1]
+        # the timestamp never changes, so the string is only built once
+        return datetime.fromtimestamp(self._timestamp).isoformat(
+            sep=" ", timespec="seconds"
+        )
 
     def __hash__(self):
-        return abs(hash(self._timestamp))
+        return hash(self._id)
 
     def __repr__(self):
         return f"{self.__class__.__qualname__}('{self._path}', {self._timestamp}, {self._file_count})"
@@ -130,35 +299,123 @@ class MetaEntry:
         return self.id_ == other.id_
 
     def to_dict(self):
-        return {
+        data = {
+            "id": self._id,
             # need(?) to convert to string prior to storing to json
             "path": str(self._path),
             "timestamp": self._timestamp,
             "file_count": self._file_count,
+            "files": self._files,
         }
+        if self._verified:
+            data["verified"] = self._verified
+        return data
 
 
 class Metadata:
+    """
+    Backup metadata is kept in .meta.log, an append-only log of json lines:
+        {"op": "add", "entry": {...}} when a backup is created
+        {"op": "rm", "id": "..."} when a backup is removed
+        {"op": "verify", "id": "...", "files": {...}} when files of a backup are found unchanged
+    so each command appends a few lines instead of rewriting the whole history.
+    The log is replayed on load and compacted into a snapshot once it holds
+    more than twice as many lines as there are live entries
+    """
+
     def __init__(self, meta_dir: Path):
         self._meta_dir = meta_dir.absolute()
-        self._entries: list[MetaEntry] = []
+        self._log_path = self._meta_dir / ".meta.log"
+        # entries are only parsed into MetaEntry objects once something asks for them
+        self._raw: list[dict] = []
+        self._log_len = 0
         try:
-            with open(self._meta_dir / ".meta.json") as f:
-                entries: list[dict] = json.load(f)
+            with open(self._log_path, "rb") as f:
+                torn = self._replay(f)
         except FileNotFoundError as e:
             Path(self._meta_dir).mkdir(exist_ok=True, parents=True)
-            with open(self._meta_dir / ".meta.json", "w") as f:
-                f.write("[]")
+            self._migrate_json()
             return
-        for entry in entries:
-            self._entries.append(MetaEntry(entry))
+        if torn:
+            # appending after a partial line would corrupt the next record too
+            self._compact()
+
+    def _replay(self, log) -> bool:
+        """rebuilds the live entries from the log, returns whether its last line was torn"""
+        entries: dict[str, dict] = {}
+        torn = False
+        for line in log:
+            self._log_len += 1
+            try:
+                record = _json_loads(line)
+            except ValueError:
+                # only the last append can be partial, after a crash mid-write
+                logging.warning("ignoring a torn line in the backup metadata log")
+                torn = True
+                continue
+            if not line.endswith(b"\n"):
+                # the record is whole but the next append would be glued onto it
+                torn = True
+            if record["op"] == "add":
+                entries[record["entry"]["id"]] = record["entry"]
+            elif record["op"] == "rm":
+                entries.pop(record["id"], None)
+            elif (entry := entries.get(record["id"])) is not None:
+                entry.setdefault("verified", {}).update(record["files"])
+        self._raw = list(entries.values())
+        return torn
+
+    def _migrate_json(self):
+        """converts the .meta.json file earlier versions kept into the log, if there is one"""
+        json_path = self._meta_dir / ".meta.json"
+        try:
+            with open(json_path, "rb") as f:
+                self._raw = _json_loads(f.read())
+        except FileNotFoundError:
+            pass
+        # entries have to go through MetaEntry as legacy ones get their id assigned there
+        self._compact()
+        json_path.unlink(missing_ok=True)
+
+    @cached_property
+    def _entries(self) -> list[MetaEntry]:
+        return [MetaEntry(data) for data in self._raw]
+
+    @cached_property
+    def _by_id(self) -> dict[str, MetaEntry]:
+        return {entry._id: entry for entry in self._entries}
+
+    @cached_property
+    def _chains(self) -> dict[Path, list[MetaEntry]]:
+        """backup chain of each directory, kept sorted chronologically"""
+        chains: dict[Path, list[MetaEntry]] = {}
+        for entry in self._entries:
+            chains.setdefault(entry._path, []).append(entry)
+        for bak_chain in chains.values():
+            bak_chain.sort(key=attrgetter("_timestamp"))
+        return chains
+
+    def _add_entry(self, entry: MetaEntry):
+        self._entries.append(entry)
+        self._by_id[entry._id] = entry
+        bisect.insort(
+            self._chains.setdefault(entry._path, []),
+            entry,
+            key=attrgetter("_timestamp"),
+        )
+
+    def _remove_entry(self, entry: MetaEntry):
+        # the chain is looked up first, building it after the removal would leave the entry out
+        bak_chain = self._chains[entry._path]
+        self._entries.remove(entry)
+        del self._by_id[entry._id]
+        bak_chain.remove(entry)
+        if not bak_chain:
+            del self._chains[entry._path]
 
     def _get_backup_chain(self, bak_dir: Path):
-        # sort all backup entries of a given directory chronologically
-        bak_chain = sorted(
-            filter(lambda x: getattr(x, "_path") == bak_dir, self._entries),
-            key=lambda x: getattr(x, "_timestamp"),
-        )
+        # all backup entries of a given directory, sorted chronologically
+        bak_chain = self._chains.get(bak_dir, [])
         if bak_chain:
             logging.info(f"got back up chain for dir {bak_dir}")
             # MetaEntries are nested inside the bakchain list therefore
@@ -167,53 +424,253 @@ class Metadata:
             logging.info(bak_chain)
         return bak_chain
 
-    def _get_last_backup_ts(self, bak_dir: Path) -> int:
-        if bak_chain := self._get_backup_chain(bak_dir):
-            return getattr(bak_chain[-1], "_timestamp")
-        return 0
-
-    def _get_all_file_paths(self, bak_dir: Path) -> list[Path]:
-        """retrieve all non-dir filepaths from scanning a dir recursively"""
-        return [file for file in bak_dir.rglob("*") if file.is_file()]
-
-    def _filter_updated_paths(self, bak_dir: Path):
-        """filters in all file paths that are new or updated"""
-        last_ts = self._get_last_backup_ts(bak_dir)
-        current_files = self._get_all_file_paths(bak_dir)
-        return list(filter(lambda x: x.stat().st_mtime > last_ts, current_files))
+    def _get_all_file_paths(
+        self, bak_dir: Path
+    ) -> Iterator[tuple[str, str, os.stat_result]]:
+        """
+        lazily retrieve all non-dir filepaths from scanning a dir recursively,
+        yields (path, path relative to bak_dir, stat) tuples
+        scandir reports entry types from the directory listing itself, so dirs are told apart
+        without an extra stat and no Path object gets built per entry.
+        The backup dir is left out, it may sit inside bak_dir and would archive its own zips
+        """
+        meta_stat = os.stat(self._meta_dir)
+        dirs = [(str(bak_dir), "")]
+        while dirs:
+            dir_path, rel_dir = dirs.pop()
+            try:
+                scanner = os.scandir(dir_path)
+            except OSError:
+                # unreadable dirs, or dirs removed while scanning
+                continue
+            with scanner:
+                for entry in scanner:
+                    rel_path = os.path.join(rel_dir, entry.name)
+                    # symlinked dirs are not followed, symlinked files are
+                    if entry.is_dir(follow_symlinks=False):
+                        # the inode comes with the listing, only a match costs a stat
+                        if entry.inode() == meta_stat.st_ino:
+                            try:
+                                if os.path.samestat(
+                                    entry.stat(follow_symlinks=False), meta_stat
+                                ):
+                                    continue
+                            except OSError:
+                                continue
+                        dirs.append((entry.path, rel_path))
+                        continue
+                    try:
+                        stat_result = entry.stat()
+                    except OSError:
+                        # dangling or looping symlinks and files removed while scanning
+                        continue
+                    if stat.S_ISREG(stat_result.st_mode):
+                        yield entry.path, rel_path, stat_result
+
+    def _filter_updated_paths(
+        self, bak_dir: Path
+    ) -> Iterator[tuple[str, str, os.stat_result, MetaEntry | None]]:
+        """
+        filters in all file paths that are new or updated, using the manifests of the backup chain
+        rather than the last backup time alone, so files copied in with an old mtime are not missed.
+        Yields (path, relative path, stat, holder) tuples, where holder is the entry that archived
+        files whose size did not change, so their contents decide whether they did
+        """
+        known_files: dict[str, list] = {}
+        holders: dict[str, MetaEntry] = {}
+        # files archived by entries that predate manifests are only known by the entry time
+        legacy_ts = 0
+        # later backups override older ones
+        for entry in self._get_backup_chain(bak_dir):
+            if entry._files:
+                known_files.update(entry._files)
+                known_files.update(entry._verified)
+                holders.update(dict.fromkeys(entry._files, entry))
+            else:
+                legacy_ts = entry._timestamp
+        for path, rel_path, stat_result in self._get_all_file_paths(bak_dir):
+            size, mtime = stat_result.st_size, stat_result.st_mtime
+            if (record := known_files.get(rel_path)) is None:
+                if mtime > legacy_ts:
+                    yield path, rel_path, stat_result, None
+            # compared whatever the time of the last backup, restoring an older backup
+            # brings back older mtimes that still differ from the newest records
+            elif [size, mtime] != record[:2]:
+                holder = holders[rel_path] if size == record[0] else None
+                yield path, rel_path, stat_result, holder
+
+    def _filter_changed_contents(
+        self,
+        files: Iterator[tuple[str, str, os.stat_result, MetaEntry | None]],
+        verified: dict[MetaEntry, dict[str, list]],
+    ) -> Iterator[tuple[str, str, os.stat_result]]:
+        """
+        filters out files whose contents are already stored in the backup chain
+        (e.g. touched or re-saved without changes), yields (path, relative path, stat) tuples
+        the [size, mtime, digest] records of the filtered out files are collected in verified,
+        per entry holding their contents, so that they are not hashed again by the next backup
+        """
+        for path, rel_path, stat_result, holder in files:
+            digest = holder._files[rel_path][2] if holder is not None else None
+            if digest is None or _file_digest(path) != digest:
+                yield path, rel_path, stat_result
+            else:
+                verified.setdefault(holder, {})[rel_path] = [
+                    stat_result.st_size,
+                    stat_result.st_mtime,
+                    digest,
+                ]
 
     @staticmethod
-    def _compress(filepaths: list[Path], zip_filepath: Path, bak_dir: Path):
-        with zipfile.ZipFile(zip_filepath, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for filepath in filepaths:
-                rel_path = filepath.relative_to(bak_dir)
-                zipf.write(filepath, rel_path)
+    def _write_pending(
+        zipf: zipfile.ZipFile, pending: deque, manifest: dict[str, list], keep: int
+    ):
+        """writes the oldest compressed files into the archive until at most `keep` remain"""
+        while len(pending) > keep:
+            rel_path, stat_result, job = pending.popleft()
+            zinfo, payload, digest = job.result()
+            _write_raw_member(zipf, zinfo, payload)
+            manifest[rel_path] = [stat_result.st_size, stat_result.st_mtime, digest]
 
-    def backup(self, bak_dirs: list[Path]):
+    @staticmethod
+    def _compress(
+        files: Iterator[tuple[str, str, os.stat_result]],
+        zip_filepath: Path,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    ) -> dict[str, list]:
+        """
+        streams files into the archive as they come out of the scanning pipeline,
+        returns the relative path -> [size, mtime, digest] manifest of the archived files
+        small files are deflated on a thread pool and spliced into the archive in order of
+        completion of the oldest job, so that all cores take part in compressing
+        """
+        # level 0 means no compression at all, useful for already compressed payloads
+        compression = (
+            zipfile.ZIP_STORED if compress_level == 0 else zipfile.ZIP_DEFLATED
+        )
+        workers = os.cpu_count() or 1
+        manifest = {}
+        with zipfile.ZipFile(
+            zip_filepath, "w", compression, compresslevel=compress_level
+        ) as zipf, ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            for path, rel_path, stat_result in files:
+                size = stat_result.st_size
+                if compression == zipfile.ZIP_STORED or size > PARALLEL_MAX_FILE_SIZE:
+                    digest = _stream_file(zipf, path, rel_path)
+                else:
+                    job = pool.submit(_deflate_file, path, rel_path, compress_level)
+                    pending.append((rel_path, stat_result, job))
+                    # bounds the number of compressed files held in memory
+                    Metadata._write_pending(zipf, pending, manifest, 2 * workers - 1)
+                    continue
+                manifest[rel_path] = [size, stat_result.st_mtime, digest]
+            Metadata._write_pending(zipf, pending, manifest, 0)
+        return manifest
+
+    def backup(
+        self, bak_dirs: list[Path], compress_level: int = DEFAULT_COMPRESS_LEVEL
+    ):
         """
         this is our public interface for backing up  folders
         the function makes sure each folder path is converted to absolute before
         getting passed to internal functions
         """
-        for bak_dir in bak_dirs:
-            bak_dir = Path(bak_dir).absolute()
-            files = self._filter_updated_paths(bak_dir)
-            if files:
-                meta_entry = self._create_meta_entry(bak_dir, len(files))
-                self._compress(
-                    files, self._meta_dir / (str(meta_entry) + ".zip"), bak_dir
+        records: list[dict] = []
+        try:
+            for bak_dir in bak_dirs:
+                bak_dir = Path(bak_dir).absolute()
+                if not os.path.isdir(bak_dir):
+                    # checked before the zip is created, the walk itself skips unreadable dirs
+                    logging.error(f"{bak_dir} is not a directory, skipping")
+                    continue
+                if os.path.samefile(bak_dir, self._meta_dir):
+                    logging.error(f"{bak_dir} is the backup directory, skipping")
+                    continue
+                # the entry names the zip file, so it has to exist before compressing.
+                # Timestamping ahead of the scan also means files modified mid-scan
+                # will be picked up by the next backup
+                meta_entry = self._create_meta_entry(bak_dir)
+                zip_filepath = self._meta_dir / (str(meta_entry) + ".zip")
+                verified: dict[MetaEntry, dict[str, list]] = {}
+                files = self._filter_changed_contents(
+                    self._filter_updated_paths(bak_dir), verified
                 )
-                self._entries.append(meta_entry)
-                self._to_json()
-            else:
-                logging.info("No files have been added or updated, skipping")
-
-    def _to_json(self):
-        with open(self._meta_dir / ".meta.json", "w") as f:
-            json.dump([meta_entry.to_dict() for meta_entry in self._entries], f)
-
-    def _create_meta_entry(self, bak_dir: Path, file_count):
-        data = {"path": bak_dir, "timestamp": time.time(), "file_count": file_count}
+                try:
+                    manifest = self._compress(files, zip_filepath, compress_level)
+                except BaseException:
+                    # no entry will point to a partly written zip
+                    zip_filepath.unlink(missing_ok=True)
+                    raise
+                # verified files stay with the entries that archived them,
+                # removing one of those gets them archived again
+                for holder, holder_files in verified.items():
+                    holder._verified.update(holder_files)
+                    records.append(
+                        {"op": "verify", "id": holder._id, "files": holder_files}
+                    )
+                if manifest:
+                    meta_entry._files = manifest
+                    meta_entry._file_count = len(manifest)
+                    self._add_entry(meta_entry)
+                    records.append({"op": "add", "entry": meta_entry.to_dict()})
+                else:
+                    zip_filepath.unlink()
+                    logging.info("No files have been added or updated, skipping")
+        finally:
+            # metadata is written once for all dirs, which also commits the
+            # dirs that were backed up before a failure
+            self._append_log(records)
+
+    def _append_log(self, records: list[dict]):
+        """durably appends records to the metadata log, compacting it when it grows too long"""
+        if not records:
+            return
+        # buffered writes retry short writes until every byte is out
+        with open(self._log_path, "ab") as f:
+            f.write(b"".join(_json_dumps(record) + b"\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_len += len(records)
+        if self._log_len > 2 * len(self._entries):
+            self._compact()
+
+    def _compact(self):
+        """
+        rewrites the log as a snapshot of the live entries. It is written to a temporary file
+        and renamed over the log, so a crash mid-write leaves the previous log intact
+        """
+        data = b"".join(
+            _json_dumps({"op": "add", "entry": meta_entry.to_dict()}) + b"\n"
+            for meta_entry in self._entries
+        )
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self._meta_dir, prefix=".meta.", suffix=".tmp", delete=False
+        ) as tmp:
+            try:
+                tmp.write(data)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        os.replace(tmp.name, self._log_path)
+        # the rename itself is only durable once the directory is synced
+        dir_fd = os.open(self._meta_dir, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self._log_len = len(self._entries)
+
+    def _create_meta_entry(self, bak_dir: Path):
+        timestamp = time.time()
+        data = {
+            "id": _entry_id(bak_dir, timestamp),
+            "path": bak_dir,
+            "timestamp": timestamp,
+            "file_count": 0,
+        }
         return MetaEntry(data)
 
     def format_backup_list(self) -> str:
@@ -231,35 +688,56 @@ class Metadata:
         dir_width = 60
         date_width = 20
 
+        # the widths are baked into the row template once instead of being parsed for every row
+        row_tmpl = f"{{id:<{id_width}}} {{dir:<{dir_width}}} {{date:<{date_width}}}"
+
         # Header
-        header = f"{'BACKUP ID':<{id_width}} {'DIRECTORY':<{dir_width}} {'DATE':<{date_width}}"
+        header = row_tmpl.format(id="BACKUP ID", dir="DIRECTORY", date="DATE")
         separator = "-" * (id_width + dir_width + date_width + 2)
 
-        lines = meta_header + [header, separator]
-
         # Data rows
-        for entry in self._entries:
-            backup_id = entry.id_
-            directory = str(entry._path)
-            date_str = entry.datetime
-
-            # Truncate if too long
-            if len(directory) > dir_width:
-                directory = "..." + directory[-dir_width + 3 :]
-
-            row = f"{backup_id:<{id_width}} {directory:<{dir_width}} {date_str:<{date_width}}"
-            lines.append(row)
+        rows = (
+            row_tmpl.format(
+                id=entry.id_,
+                dir=_truncate(str(entry._path), dir_width),
+                date=entry.datetime,
+            )
+            for entry in self._entries
+        )
 
-        return "\n".join(lines)
+        return "\n".join(chain(meta_header, (header, separator), rows))
 
     def _get_bak_meta(self, bak_id: str) -> tuple[Path, int] | None:
-        for entry in self._entries:
-            if getattr(entry, "id_") == bak_id:
-                return (getattr(entry, "_path"), getattr(entry, "_timestamp"))
+        if entry := self._by_id.get(bak_id):
+            return (entry._path, entry._timestamp)
 
     def _extract(self, entry: MetaEntry):
+        """
+        extracts a backup over its directory, copying each member in large blocks into a
+        preallocated file. Modification times are restored as well, so that the next backup
+        does not treat every restored file as updated
+        """
         with zipfile.ZipFile(self._meta_dir / (str(entry) + ".zip"), "r") as zipf:
-            zipf.extractall(getattr(entry, "_path"))
+            for info in zipf.infolist():
+                # same sanitizing as ZipFile.extractall, members cannot escape the target dir
+                rel_path = os.sep.join(
+                    part
+                    for part in info.filename.split("/")
+                    if part not in ("", os.curdir, os.pardir)
+                )
+                target = entry._path / rel_path
+                if info.is_dir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with zipf.open(info) as src, open(target, "wb") as dst:
+                    _fallocate(dst.fileno(), info.file_size)
+                    shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+                # the manifest keeps the exact mtime, zip only stores it to 2 seconds
+                mtime = entry._files.get(rel_path, [None, None])[1]
+                if mtime is None:
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                os.utime(target, (mtime, mtime))
 
     def restore(self, bak_ids: list[str]):
         for bak_id in bak_ids:
@@ -267,21 +745,22 @@ class Metadata:
             if bak_meta is None:
                 logging.error("backup id not found, skipping")
                 continue
-            bak_chain = list(
-                filter(
-                    lambda x: getattr(x, "_timestamp") <= bak_meta[1],  # type: ignore
-                    self._get_backup_chain(bak_meta[0]),
-                )
+            bak_chain = self._get_backup_chain(bak_meta[0])
+            # the chain is sorted, so the requested backup and its predecessors are a prefix
+            restore_count = bisect.bisect_right(
+                bak_chain, bak_meta[1], key=attrgetter("_timestamp")
             )
-            for entry in bak_chain:
+            for entry in bak_chain[:restore_count]:
                 self._extract(entry)
 
-    def _find_index_by_id(self, bak_id) -> int | None:
-        for i in range(len(self._entries)):
-            if self._entries[i].id_ == bak_id:
-                return i
-
     def rm(self, back_ids: list[str], all=False):
+        removed: list[MetaEntry] = []
+        try:
+            self._rm(back_ids, all, removed)
+        finally:
+            self._append_log([{"op": "rm", "id": e._id} for e in removed])
+
+    def _rm(self, back_ids: list[str], all: bool, removed: list[MetaEntry]):
         for bak_id in back_ids:
             if all:
                 "find bak dir of the bak id, find all MetaEntry instances of the bak dir, remove all those instances from self._entries:"
@@ -290,38 +769,35 @@ class Metadata:
                 back_meta = self._get_bak_meta(bak_id)
                 if back_meta is not None:
                     bak_dir = back_meta[0]
-                    for entry in self._entries:
-                        if entry._path == bak_dir:
-                            (self._meta_dir / (str(entry) + ".zip")).unlink()
-                    self._entries = [
-                        entry for entry in self._entries if entry._path != bak_dir
-                    ]
+                    for entry in list(self._chains[bak_dir]):
+                        (self._meta_dir / (str(entry) + ".zip")).unlink()
+                        self._remove_entry(entry)
+                        removed.append(entry)
 
                 else:
                     logging.error(f"backup id {bak_id} not found, skipping")
             else:
-                entry_index = self._find_index_by_id(bak_id)
-                if entry_index is not None:
+                rm_entry = self._by_id.get(bak_id)
+                if rm_entry is not None:
                     try:
-                        rm_entry = self._entries[entry_index]
                         (self._meta_dir / Path(str(rm_entry) + ".zip")).unlink()
                     except FileNotFoundError as e:
                         logging.error("failed to remove backup" + str(e))
-                    del self._entries[entry_index]
+                    self._remove_entry(rm_entry)
+                    removed.append(rm_entry)
                     logging.info(f"removed {rm_entry}from registry")
                 else:
                     logging.error(f"backup id {bak_id} not found, skipping")
 
-        self._to_json()
-
 
 if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
     setup_logging(args.verbose)
     output_dir = Path(args.output)
     metadata = Metadata(output_dir)
     if args.command == "create":
-        metadata.backup(args.create_dir_paths)
+        metadata.backup(args.create_dir_paths, args.compress_level)
     elif args.command == "list":
         print(metadata.format_backup_list())
     elif args.command == "restore":
@@ -5,7 +5,9 @@ Script for reporting sizes of files and length of directory contents
 """
 
 import argparse
+import os
 import pathlib
+import stat
 import sys
 
 arg_parser = argparse.ArgumentParser(add_help=True)
@@ -14,35 +16,46 @@ arg_parser.add_argument("paths", nargs="*", help="files-directories to process")
 arg_parser.add_argument("--verbose", "-v", action="store_true", help="verbose mode")
 
 
-def parse_path(path: str | pathlib.Path, verbose=False):
+def parse_path(path: str | pathlib.Path, verbose=False) -> str:
     """Routing function. Will delegate to parse_dir if path is a directory, or parse_file if path is a file
 
     Args:
         path: Path object or stringified file path pointing to the dir to be processed
         verbose: bool object, used to control output verbosity
 
+    Returns:
+        the report line of the path
+
     Raises:
         FileNotFound, if provided path, does not correspond to a file or dir
     """
-    path = pathlib.Path(path)
-
-    if path.is_dir():
-        _parse_dir(path, verbose=verbose)
-    elif path.is_file():
-        _parse_file(path, verbose=verbose)
+    # paths stay strings unless they are needed as Path objects, files are handled with plain os calls
+    path = os.fspath(path)
+
+    # a single stat routes the path and gives the file size, instead of separate is_dir/is_file/stat calls
+    try:
+        path_stat = os.stat(path)
+    except (OSError, ValueError):
+        # same as is_dir/is_file, which treat any path that cannot be stat'ed as missing
+        raise FileNotFoundError(f"{path} cannot be found skipping") from None
+
+    if stat.S_ISDIR(path_stat.st_mode):
+        return _parse_dir(pathlib.Path(path), verbose=verbose)
+    elif stat.S_ISREG(path_stat.st_mode):
+        return _parse_file(path, path_stat.st_size, verbose=verbose)
     else:
         raise FileNotFoundError(f"{path} cannot be found skipping")
 
 
-def _parse_dir(path: pathlib.Path, verbose: bool):
-    """Function that prints the file/dir count of a directory
+def _parse_dir(path: pathlib.Path, verbose: bool) -> str:
+    """Function that reports the file/dir count of a directory
 
     Args:
         path: Path object pointing to the dir to be processed
         verbose: bool object, used to control output verbosity
 
     Returns:
-        None
+        the report line of the directory
 
     Note:
         Expects path arg to be a Path object and pointing to a directory
@@ -52,38 +65,38 @@ def _parse_dir(path: pathlib.Path, verbose: bool):
 
     stringified_path = _get_verbose(path) if verbose else path.name
 
-    contents_list = list(path.iterdir())
-
-    dir_count = list(filter(pathlib.Path.is_dir, contents_list))
+    # scandir entries know their type from the directory listing, so unlike
+    # Path.is_dir/is_file they only need a stat call for symlinks
+    file_count = dir_count = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                dir_count += 1
+            elif entry.is_file():
+                file_count += 1
 
-    file_count = list(filter(pathlib.Path.is_file, contents_list))
-
-    print(
-        stringified_path,
-        "is a directory. It contains",
-        len(file_count),
-        "files and",
-        len(dir_count),
-        "directories",
-    )
+    return f"{stringified_path} is a directory. It contains {file_count} files and {dir_count} directories"
 
 
-def _parse_file(path: pathlib.Path, verbose: bool):
-    """Function that prints the size of a non-dir file
+def _parse_file(path: str, size: int, verbose: bool) -> str:
+    """Function that reports the size of a non-dir file
 
     Args:
-        path: Path object pointing to the file to be processed
+        path: stringified file path pointing to the file to be processed
+        size: size of the file in bytes, as already stat'ed by parse_path
         verbose: bool object, used to control output verbosity
 
     Returns:
-        None
+        the report line of the file
 
     Note:
-        Expects path arg to be a Path object and pointing to a file
+        Expects path arg to be pointing to a file, a Path object is only built in verbose mode
     """
-    stringified_path = _get_verbose(path) if verbose else path.name
+    stringified_path = (
+        _get_verbose(pathlib.Path(path)) if verbose else os.path.basename(path)
+    )
 
-    print(stringified_path, "is a file of size", path.stat().st_size, "bytes")
+    return f"{stringified_path} is a file of size {size} bytes"
 
 
 def _get_verbose(path: pathlib.Path) -> str:
@@ -101,16 +114,21 @@ def _get_verbose(path: pathlib.Path) -> str:
 def main():
     args = arg_parser.parse_args()
     if not args.paths:
-        args.paths = [
-            path.strip() for path in sys.stdin.read().split("\n") if path.strip()
-        ]
+        # stdin is read line by line instead of being buffered whole before splitting
+        args.paths = [path.strip() for path in sys.stdin if path.strip()]
     exit_code = 0
-    for path in args.paths:
-        try:
-            parse_path(path, args.verbose)
-        except (FileNotFoundError, TypeError) as e:
-            exit_code = 1
-            print(e)
+    # report lines are collected and written at once rather than printed path by path
+    out_lines = []
+    try:
+        for path in args.paths:
+            try:
+                out_lines.append(parse_path(path, args.verbose))
+            except (FileNotFoundError, TypeError) as e:
+                exit_code = 1
+                out_lines.append(str(e))
+    finally:
+        if out_lines:
+            sys.stdout.write("\n".join(out_lines) + "\n")
     sys.exit(exit_code)
 
 
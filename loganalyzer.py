@@ -7,16 +7,23 @@ Return log message stats.
 - Can output to file with the -o, --output option (default is console)
 """
 
+import mmap
+import os
 import sys
 import pathlib
 import re
 import argparse
 from collections import Counter
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
 import json
 
 # Regex pattern for validating an log entry, and isolating the log type, should work with simple dates and anything more detailed
-PATTERN = r"\d{4}-\d{2}-\d{2}(?: [,:0-9TZ]+)?[^ ]* ([A-Z]{4,})"
+# It runs over the raw bytes of a whole file, so it is anchored at line starts and may not cross a newline
+# The quantifiers are possessive as giving characters back could never lead to a match, which saves
+# re from backtracking through every line that is not a log entry
+PATTERN = rb"(?m)^\d{4}-\d{2}-\d{2}(?: [,:0-9TZ]++)?[^ \n]*+ ([A-Z]{4,})"
+# Compiled once, so matching a file skips the lookup in re's pattern cache
+_PAT = re.compile(PATTERN)
 
 parser = argparse.ArgumentParser(
     __name__,
@@ -33,22 +40,30 @@ parser.add_argument(
 parser.add_argument("-o", "--output", help="switch output to the desired file")
 
 
-def _classify_msgs(msgs: list[str]) -> Counter:
-    """Function that receives text lines from logs and counts logging types into a Counter dictionary"""
-    counter = Counter()
-    for msg in msgs:
-        if match := re.match(PATTERN, msg):
-            counter[match.group(1)] += 1
-    return counter
+def _classify_msgs(data: bytes | mmap.mmap) -> Counter:
+    """Function that receives the contents of a log and counts logging types into a Counter dictionary of bytes levels"""
+    # findall walks every line in C and Counter tallies the raw level tokens in C as well,
+    # levels stay bytes until the output is built
+    return Counter(_PAT.findall(data))
 
 
 def _log2dict(path: pathlib.Path | str) -> Counter:
-    """Extracts log stats from a text file"""
+    """Extracts log stats from a file, files without log lines (binary ones included) give an empty Counter"""
     # Converts path to Path object if it isn't already
     path = pathlib.Path(path)
 
-    with open(path, encoding="utf-8") as f:
-        return _classify_msgs(f.readlines())
+    # The file is mapped instead of read and the pattern runs over the raw bytes,
+    # so nothing is decoded and files need no text check beforehand
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                return Counter()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _classify_msgs(data)
+    except OSError:
+        # missing and unreadable paths are skipped, as they were by the text check
+        return Counter()
 
 
 def _handle_output(
@@ -88,20 +103,42 @@ def _expand_dir(filepath_list: list[str] | list[pathlib.Path]) -> list[str]:
     """Expands all dirs in a filepath list and returns a new list with non-dir paths"""
     expanded_paths = []
     for path in filepath_list:
-        if pathlib.Path(path).is_dir():
-            expanded_paths.extend(_expand_dir(list(pathlib.Path(path).iterdir())))
-        else:
+        if not os.path.isdir(path):
             expanded_paths.append(path)
+            continue
+        # Walks the tree with an explicit stack of dirs instead of recursing, scandir
+        # tells files from dirs with the types readdir already returned
+        dirs = [os.fspath(path)]
+        while dirs:
+            try:
+                scanner = os.scandir(dirs.pop())
+            except OSError:
+                continue
+            subdirs = []
+            with scanner:
+                for entry in scanner:
+                    try:
+                        # symlinked dirs are followed as they were with Path.is_dir
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        subdirs.append(entry.path)
+                    else:
+                        expanded_paths.append(entry.path)
+            # reversed so that subdirs are popped, and listed, in the order they were found
+            dirs.extend(reversed(subdirs))
     return expanded_paths
 
 
-def _is_text(file_path):
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            f.read(1024000000)
-        return True
-    except Exception:
-        return False
+def _log2dicts(filepath_list: list[pathlib.Path]) -> list[Counter]:
+    """Extracts log stats from each file, fanning the files out to worker processes when there are several"""
+    if len(filepath_list) <= 1:
+        return list(map(_log2dict, filepath_list))
+    # one file per task, so that a few big logs are not all handed to the same worker
+    workers = min(len(filepath_list), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_log2dict, filepath_list, chunksize=1))
 
 
 def parse_files(
@@ -121,21 +158,24 @@ def parse_files(
     exit_code = 0
     if expand_dir:
         filepath_list = _expand_dir(filepath_list)
-    filepath_list = list(
-        filter(_is_text, map(pathlib.Path, [path for path in filepath_list]))
-    )
-    # Not efficient but filters out files containing no logs from the processed files entry
-    filepath_list = list(filter(_log2dict, filepath_list))
+    filepath_list = list(map(pathlib.Path, filepath_list))
+    results = []
     try:
-        total_counter = reduce(
-            lambda x, y: x + y, map(_log2dict, filepath_list), total_counter
-        )
+        results = list(zip(filepath_list, _log2dicts(filepath_list)))
     except (TypeError, FileNotFoundError) as e:
         print(e)
         exit_code = 1
+    # Each file is parsed once, files containing no logs are then left out of the processed files entry
+    results = [(path, counter) for path, counter in results if counter]
+    # Counters are merged in place, adding them up would build a new Counter for every file
+    for _, counter in results:
+        total_counter.update(counter)
+    filepath_list = [path for path, _ in results]
     output = {
         "total_lines": sum(total_counter.values()),
-        "log_levels": total_counter.copy(),
+        "log_levels": {
+            level.decode(): count for level, count in total_counter.items()
+        },
         "files_processed": list(map(str, filepath_list)),
     }
 
@@ -146,9 +186,8 @@ def parse_files(
 def main():
     args = parser.parse_args()
     if not args.filepaths:
-        args.filepaths = [
-            path.strip() for path in sys.stdin.read().split("\n") if path.strip()
-        ]
+        # stdin is read line by line instead of being buffered whole before splitting
+        args.filepaths = [path.strip() for path in sys.stdin if path.strip()]
     parse_files(args.filepaths, args.output, args.json, args.expand_dir)
 
 